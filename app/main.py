@@ -14,9 +14,12 @@ import re
 import cv2
 import base64
 import numpy as np
-from PIL import Image
-from io import BytesIO
 import configparser
+import logging
+import functools
+import threading
+import hashlib
+from collections import OrderedDict
 import shutil
 import os
 
@@ -28,6 +31,11 @@ if not CONFIG_FILE_PATH.is_file():
     shutil.copy(CONFIG_FILE_TEMPLATE, CONFIG_FILE_PATH)
 config.read(CONFIG_FILE_PATH)
 STATIC_URL_PATH = '/static'
+logger = logging.getLogger(__name__)
+# 7 digit product id on the shelf tags
+TAG_ID_PATTERN = re.compile(r"(\d{7})\D")
+# quality of the annotated camera frames sent back to the client
+JPEG_QUALITY = 85
 
 # Init the server
 app = Flask(__name__, static_url_path=STATIC_URL_PATH)
@@ -39,62 +47,88 @@ pathplanner = Pathplanner(map_image_path='pathplanning/map.png', locations=produ
 
 ### helper functions ###
 
-def build_map(coin_list, location, item_list, path_list):
-    svg_map = ""
+def parse_location(location_str):
+    '''Parse a "(y, x)" location from a query argument'''
+    y, x = location_str.strip('() ').split(',')
+    return int(y), int(x)
 
-    # Path
-    path_str = """<path d="M {0} {1}""".format(location[1], location[0])
-    for path in path_list:
-        path_str = path_str + "L {} {}".format(path[1], path[0])
 
-    path_str = path_str + """" stroke="black" fill="transparent" style="stroke:gray;stroke-width:10"/>"""
+def decode_image(img_bytes):
+    '''Decode the uploaded frame into a BGR image, None if it can't be decoded'''
+    return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
 
-    svg_map = svg_map + path_str
 
-    #Coins
+def _build_coins_svg(coin_list):
+    parts = []
     for coin in coin_list:
-        svg_map = svg_map + """
-            <ellipse cx="{0}" cy="{1}" rx="20" ry="25" style="fill:#efc501;stroke:#98720b;stroke-width:5">
+        parts.append(f"""
+            <ellipse cx="{coin[0]}" cy="{coin[1]}" rx="20" ry="25" style="fill:#efc501;stroke:#98720b;stroke-width:5">
                 <animate 
                 attributeName="rx" 
                 values="20; 2; 20" begin="0s" dur="5s" calcMode="linear" keyTimes="0; 0.5; 1" repeatCount="indefinite"/>
             </ellipse>
-	        <line x1="{0}" y1="{2}" x2="{0}" y2="{3}" style="stroke:#98720b;opacity:1;stroke-width:10" />
-	        """.format(coin[0], coin[1], coin[1] - 10, coin[1] + 10)
+	        <line x1="{coin[0]}" y1="{coin[1] - 10}" x2="{coin[0]}" y2="{coin[1] + 10}" style="stroke:#98720b;opacity:1;stroke-width:10" />
+	        """)
+    return "".join(parts)
+
+
+# the coins never move, so their svg is built only once
+COIN_LIST = ((440, 25), (210, 320))
+COINS_SVG = _build_coins_svg(COIN_LIST)
+
+
+def build_map(coin_list, location, item_list, path_list):
+    # repeated requests for the same state get the memoized svg
+    # the path is keyed by its raw bytes, much cheaper than a tuple of its points
+    path_bytes = np.asarray(path_list, dtype=np.int16).tobytes()
+    return _build_map_cached(tuple(map(tuple, coin_list)), tuple(location),
+                             tuple(map(tuple, item_list)), path_bytes)
+
+
+@functools.lru_cache(maxsize=128)
+def _build_map_cached(coin_list, location, item_list, path_bytes):
+    parts = []
+
+    # Path
+    path_list = np.frombuffer(path_bytes, dtype=np.int16).reshape(-1, 2)
+    parts.append(f"""<path d="M {location[1]} {location[0]}""")
+    # one format call for all (x, y) points instead of one per point
+    parts.append(("L {} {}" * len(path_list)).format(*path_list[:, ::-1].ravel().tolist()))
+    parts.append("""" stroke="black" fill="transparent" style="stroke:gray;stroke-width:10"/>""")
+
+    #Coins
+    parts.append(COINS_SVG if coin_list == COIN_LIST else _build_coins_svg(coin_list))
 
     #Loactaion
-    svg_map = svg_map + """
+    parts.append(f"""
     <!-- Location -->
-    <polygon points="{0},{1} {2},{3} {4},{5}" id="location" style="fill:#ffe300;fill-opacity:0.5;stroke:#003278;stroke-width:5" />
-    <circle cx="{0}" cy="{1}" r="20" stroke="#003278" stroke-width="5" fill="#ffe300"/>
-    """.format(location[1],location[0], location[1]-40, location[0]-100, location[1]+40, location[0]-100)
+    <polygon points="{location[1]},{location[0]} {location[1]-40},{location[0]-100} {location[1]+40},{location[0]-100}" id="location" style="fill:#ffe300;fill-opacity:0.5;stroke:#003278;stroke-width:5" />
+    <circle cx="{location[1]}" cy="{location[0]}" r="20" stroke="#003278" stroke-width="5" fill="#ffe300"/>
+    """)
 
     # Items
-    counter = 0
-    print(item_list)
-    for item in item_list:
-        svg_map = svg_map + """
+    logger.debug("items on the map: %s", item_list)
+    for counter, item in enumerate(item_list):
+        parts.append(f"""
         <!-- Item -->
-        <circle cx="{0}" cy="{1}" r="20" stroke="#003278" stroke-width="5" fill="#ffe300" />
-	    <text x="{2}" y="{3}" fill="#003278" font-size="2em">{4}</text>
-	    """.format(item[1],item[0],item[1]-9, item[0]+10, counter)
-        counter = counter + 1
+        <circle cx="{item[1]}" cy="{item[0]}" r="20" stroke="#003278" stroke-width="5" fill="#ffe300" />
+	    <text x="{item[1]-9}" y="{item[0]+10}" fill="#003278" font-size="2em">{counter}</text>
+	    """)
 
-    svg_end = """</svg>"""
-    svg = svg_map + svg_end
-    return svg
+    parts.append("""</svg>""")
+    return "".join(parts)
 
 
 user_id = 0
 
 @dataclass
 class UserData:
-    einkaufszettel: list
+    einkaufszettel: set
 
 user_datas = {
     # format: USER_ID: UserData
     # currently there is only user 0
-    0: UserData([]),
+    0: UserData(set()),
 }
 
 pizzas = [
@@ -118,6 +152,9 @@ pizzas = [
     {'id': '0926460', 'price': '1.23', 'text': 'Vollmilch', 'url': '/static/milch.png'},
     {'id': '0173628', 'price': '2.50', 'text': 'Tomaten', 'url': '/static/tomaten.jpg'}
 ]
+for pizza in pizzas:
+    pizza['price_float'] = float(pizza['price'])
+PIZZAS_BY_ID = {pizza['id']: pizza for pizza in pizzas}
 
 ### STATIC FLASK PART ###
 @app.route('/')
@@ -133,15 +170,15 @@ def main():
     # IDs correspond to the ones in `product_locations`
 
 
-    for counter, item in enumerate(pizzas):
+    for item in pizzas:
         if item['id'] in user_datas[user_id].einkaufszettel:
-            pizzas[counter]["class"] = 'bg-warning'
-            pizzas[counter]["inbasket"] = 'true'
+            item["class"] = 'bg-warning'
+            item["inbasket"] = 'true'
         else:
-            pizzas[counter]["class"] = 'swatch-400'
-            pizzas[counter]["inbasket"] = 'false'
+            item["class"] = 'swatch-400'
+            item["inbasket"] = 'false'
 
-    print(pizzas)
+    logger.debug("products: %s", pizzas)
 
     now = datetime.now()
     date_time_str = now.strftime("%m/%d/%Y, %H:%M:%S")
@@ -149,12 +186,13 @@ def main():
 
 
 def _get_path_for_einkaufszettel(user_location):
-    print(f"We're supposed to collect all these item IDs: {user_datas[user_id].einkaufszettel}")
-    selected_artikel_eans = user_datas[user_id].einkaufszettel
+    # snapshot, socket messages may change the shopping list while we plan
+    selected_artikel_eans = frozenset(user_datas[user_id].einkaufszettel)
+    logger.debug("We're supposed to collect all these item IDs: %s", selected_artikel_eans)
     end_ean = '_kasse'
-    print(f"calling get_path({user_location}, {selected_artikel_eans}, {end_ean})")
+    logger.debug("calling get_path(%s, %s, %s)", user_location, selected_artikel_eans, end_ean)
     path, route_eans = pathplanner.get_path(user_location, selected_artikel_eans, end_ean)  # [(0, 0), (0, 1), (0, 1), (0, 2), (0, 3), (0, 4), ...], [0 3 2 1]
-    print(f"calculated route is {route_eans}")
+    logger.debug("calculated route is %s", route_eans)
     return path, route_eans
 
 
@@ -164,37 +202,33 @@ def navigation():
     user_location = request.args.get('user_location')
     item_id = request.args.get('item_id')
     if user_location is not None:
-        user_location = eval(user_location)
+        user_location = parse_location(user_location)
     else:
         user_location = (850, 60)  # y,x
 
     #remove item from shopping list if there ist one
     if item_id is not None:
-        if item_id in user_datas[user_id].einkaufszettel:
-            user_datas[user_id].einkaufszettel.remove(item_id)
-
-    coin_list = [(440, 25), (210, 320)]
+        user_datas[user_id].einkaufszettel.discard(item_id)
 
     path_list, item_list = _get_path_for_einkaufszettel(user_location)
     item_locations = [product_locations[id] for id in item_list if id not in ["_user", "_kasse"]]
-    print(item_locations)
-    print(item_list)
+    logger.debug("item locations %s of items %s", item_locations, item_list)
     #GET DETAILS
-    for item in pizzas:
-        if item['id'] == item_list[1]:
-            item_name = item['text']
-            item_path = item['url']
-            item_price = item['price']
+    item = PIZZAS_BY_ID.get(item_list[1])
+    if item is not None:
+        item_name = item['text']
+        item_path = item['url']
+        item_price = item['price']
 
     if len(item_locations) > 0:
-        redirect = '/navigation?user_location={}&item_id={}'.format(item_locations[0],item_list[1])
+        redirect = f'/navigation?user_location=({item_locations[0][0]},{item_locations[0][1]})&item_id={item_list[1]}'
     else:
         redirect = '/'
         item_name = "Finished"
         item_path = ""
         item_price = ""
 
-    svg = build_map(coin_list, user_location, item_locations, path_list)
+    svg = build_map(COIN_LIST, user_location, item_locations, path_list)
     return render_template('navigation.html', item_name = item_name, item_path=item_path, item_price=item_price, redirect=redirect, svg=svg, user_x = user_location[0], user_y= user_location[1])
 
 
@@ -208,18 +242,45 @@ def mobile():
     return render_template('phone.html')
 
 client = vision.ImageAnnotatorClient()
+VISION_CACHE_SIZE = 256
+_vision_cache = OrderedDict()  # sha1 of image -> text annotations
+_vision_cache_lock = threading.Lock()  # requests are served from several threads
+
+
+def get_text_annotations(img_bytes):
+    '''
+    Run the text detection of the vision api on the image.
+    Frames we have seen before are answered from the cache without calling the api.
+    '''
+    key = hashlib.sha1(img_bytes).digest()
+    with _vision_cache_lock:
+        texts = _vision_cache.get(key)
+        if texts is not None:
+            _vision_cache.move_to_end(key)
+            return texts
+
+    response = client.annotate_image(
+        {'image': {'content': img_bytes}}
+    )
+    texts = response.text_annotations
+    with _vision_cache_lock:
+        _vision_cache[key] = texts
+        if len(_vision_cache) > VISION_CACHE_SIZE:
+            _vision_cache.popitem(last=False)
+    return texts
+
 
 def get_left_right_direction(detected_tags, goal_tag):
     known_tags = ["0003376", "0000305", "0007873", "0119704", "0001847"]
     try:
         goal_ndx = known_tags.index(goal_tag)
     except ValueError:
-        print("Goal tag '%s' is unkown" % goal_tag)
+        logger.warning("Goal tag '%s' is unkown", goal_tag)
         return None    
 
     # loop over all tags in case one is invalid
     for t in detected_tags:
-        print(t)
+        logger.debug("detected tag %s", t)
         try:
             current_ndx = known_tags.index(t)
             return goal_ndx - current_ndx
@@ -234,19 +295,17 @@ def whereami():
         return render_template('video.html')
     else:
         base64_input = request.form.get('base64')[22:]
-        response = client.annotate_image(
-            {'image': {'content': binascii.a2b_base64(base64_input)} }
-        )
-        texts = response.text_annotations
+        img_bytes = binascii.a2b_base64(base64_input)
+        texts = get_text_annotations(img_bytes)
         list_id_numbers = []
         list_boundaries = []
         for text in texts:
-            x = re.search(r"(\d{7})\D",str(text))
+            x = TAG_ID_PATTERN.search(str(text))
             if x != None:
                 vertices = text.bounding_poly.vertices
                 for vertice in vertices:
                     list_boundaries.append((vertice.x, vertice.y))
-                list_id_numbers.append(re.sub('\D', '', x.group()))
+                list_id_numbers.append(x.group(1))
                 break
 
         if list_id_numbers == 0:
@@ -255,16 +314,19 @@ def whereami():
         socketio.emit('server_client_namespace', {'box':list_boundaries})
 
         user_location = product_locations[list_id_numbers[0]]
-        image = stringToRGB(request.form.get('base64')[22:])
-        color = (255, 0, 0)
+        image = decode_image(img_bytes)
+        if image is None:
+            logger.warning("could not decode the uploaded frame")
+            return render_template('video.html')
+        color = (0, 0, 255)  # red, opencv images are BGR
         thickness = 2
         image = cv2.rectangle(image, list_boundaries[0], list_boundaries[2], color, thickness)
 
-        img = Image.fromarray(image, 'RGB')
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")  #
-        myimage = buffer.getvalue()
-        print("data:image/jpeg;base64,"+ base64.b64encode(myimage).decode("utf-8"))
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            logger.warning("could not encode the annotated frame")
+            return render_template('video.html')
+        myimage = buffer.tobytes()
 
         svg = """
         <svg id="svg-object" viewBox="0 0 {0} {1}" xmlns="http://www.w3.org/2000/svg">
@@ -274,18 +336,6 @@ def whereami():
         return render_template('video2.html', svg = svg, redirect='/navigation?user_location={}'.format(user_location))
 
 
-def stringToRGB(base64_string):
-    imgdata = base64.b64decode(str(base64_string))
-    image = Image.open(BytesIO(imgdata))
-    return cv2.cvtColor(np.array(image), cv2.COLOR_BGR2RGB)
-
-def im_2_b64(image):
-    buff = BytesIO()
-    image.save(buff, format="PNG")
-    img_str = base64.b64encode(buff.getvalue())
-    return img_str
-
-
 @app.route('/whereis', methods=['POST', 'GET'])
 def whereis():
     if request.method == 'GET':
@@ -295,21 +345,18 @@ def whereis():
     else:
 
         base64_input = request.form.get('base64')[22:]
-        print(base64_input)
 
-        response = client.annotate_image(
-            {'image': {'content': binascii.a2b_base64(base64_input)}}
-        )
-        texts = response.text_annotations
+        img_bytes = binascii.a2b_base64(base64_input)
+        texts = get_text_annotations(img_bytes)
         list_id_numbers = []
         list_boundaries = []
         for text in texts:
-            x = re.search(r"(\d{7})\D",str(text))
+            x = TAG_ID_PATTERN.search(str(text))
             if x != None:
                 vertices = text.bounding_poly.vertices
                 for vertice in vertices:
                     list_boundaries.append((vertice.x, vertice.y))
-                list_id_numbers.append(re.sub('\D', '', x.group()))
+                list_id_numbers.append(x.group(1))
                 break
 
         if len(list_id_numbers) == 0:
@@ -321,16 +368,19 @@ def whereis():
             text = ""
 
         user_location = product_locations[list_id_numbers[0]]
-        image = stringToRGB(request.form.get('base64')[22:])
-        color = (255, 0, 0)
+        image = decode_image(img_bytes)
+        if image is None:
+            logger.warning("could not decode the uploaded frame")
+            return render_template('whereis.html', hidden="none", text="Could not read image", arrow=90)
+        color = (0, 0, 255)  # red, opencv images are BGR
         thickness = 2
         image = cv2.rectangle(image, list_boundaries[0], list_boundaries[2], color, thickness)
 
-        img = Image.fromarray(image, 'RGB')
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")  #
-        myimage = buffer.getvalue()
-        print("data:image/jpeg;base64,"+ base64.b64encode(myimage).decode("utf-8"))
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            logger.warning("could not encode the annotated frame")
+            return render_template('whereis.html', hidden="none", text="Could not read image", arrow=90)
+        myimage = buffer.tobytes()
 
         svg = """
         <svg id="svg-object" viewBox="0 0 {0} {1}" xmlns="http://www.w3.org/2000/svg">
@@ -339,7 +389,7 @@ def whereis():
         """.format(int(request.form.get('x')), int(request.form.get('y')), "data:image/jpeg;base64,"+ base64.b64encode(myimage).decode("utf-8"))
 
         direction = get_left_right_direction(list_id_numbers, "0007873")
-        print(direction)
+        logger.debug("direction to goal tag: %s", direction)
 
 
         redirect = '/whereis'
@@ -378,24 +428,20 @@ def message_recieved(data):
     We are just going to send it back to the client to adjust the value displyed 
     Using emit will send the Data to all client which are connencted...
     '''
-    print(data)
+    logger.debug("received %s", data)
 
     if data['inbasket'] == 1:
-        user_datas[user_id].einkaufszettel.append(data['product'])
+        user_datas[user_id].einkaufszettel.add(data['product'])
     else:
-        if data['product'] in user_datas[user_id].einkaufszettel:
-            user_datas[user_id].einkaufszettel.remove(data['product'])
+        user_datas[user_id].einkaufszettel.discard(data['product'])
 
-    total_price=0
-    for product_id in user_datas[user_id].einkaufszettel:
-        for pizza in pizzas:
-            if pizza['id'] == product_id:
-                total_price+=float(pizza['price'])
-    total_price = round(total_price, 2)
+    einkaufszettel = frozenset(user_datas[user_id].einkaufszettel)
+    total_price = round(sum(PIZZAS_BY_ID[product_id]['price_float']
+                            for product_id in einkaufszettel if product_id in PIZZAS_BY_ID), 2)
     emit('server_client_namespace', total_price)
     #emit('server_client_namespace', data)
     
-    print(f"einkaufszettel ist: {user_datas[user_id].einkaufszettel}")
+    logger.debug("einkaufszettel ist: %s", einkaufszettel)
 
 
 def _get_ssl_context():
@@ -411,6 +457,7 @@ def _get_ssl_context():
 # Actually Start the App
 if __name__ == '__main__':
     """ Run the app. """
+    logging.basicConfig(level=logging.DEBUG if config['FLASK']['debug'] == 'True' else logging.INFO)
     if config['FLASK']['debug'] == 'True':
         socketio.run(app, ssl_context='adhoc', port = config['FLASK']['port'], host = config['FLASK']['host'], debug=True)
     else:
@@ -1,21 +1,71 @@
 import re
 from typing import Dict, Tuple, Set, List
 from pathlib import Path
-# https://stackoverflow.com/a/62354885/5559867  # noqa E402
-import six  # noqa E402
-import sys  # noqa E402
-sys.modules['sklearn.externals.six'] = six  # noqa E402
-import mlrose  # noqa E402
 import numpy as np
 import skimage.io
 import skimage.graph
-import tqdm
 import pickle
 import os
 import hashlib
-from six import string_types
+import logging
+import threading
+from collections import OrderedDict
+try:
+    from numba import njit
+except ImportError:  # numba is optional, without it the line of sight check runs as plain python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+logger = logging.getLogger(__name__)
 
 CACHE_PATH = 'cache.pickle'
+# bump whenever the format of the cached distances and paths changes
+CACHE_VERSION = 4
+# map cost of a fully passable (white) pixel, anything above blocks the line of sight
+FREE_COST = 1
+# larger tsp problems are solved heuristically, held-karp needs O(2^n * n^2) time
+HELD_KARP_MAX_NODES = 16
+# user locations within the same cell of this size (px) share their routes to the products
+USER_LOCATION_SNAP = 10
+USER_ROUTES_CACHE_SIZE = 256
+ROUTE_CACHE_SIZE = 128
+
+
+@njit(cache=True)
+def _bresenham(y0, x0, y1, x1):
+    """Integer bresenham line from (y0, x0) to (y1, x1) as (n, 2) array, both ends included."""
+    dy = abs(y1 - y0)
+    dx = abs(x1 - x0)
+    sy = 1 if y1 > y0 else -1
+    sx = 1 if x1 > x0 else -1
+    line = np.empty((max(dy, dx) + 1, 2), dtype=np.int64)
+    err = dx - dy
+    y, x = y0, x0
+    for k in range(line.shape[0]):
+        line[k, 0] = y
+        line[k, 1] = x
+        e2 = 2 * err
+        if e2 > -dy:
+            err -= dy
+            x += sx
+        if e2 < dx:
+            err += dx
+            y += sy
+    return line
+
+
+@njit(cache=True)
+def _los_blocks(tmap, y0, x0, y1, x1):
+    """Return True if any pixel on the straight line between the two points is not free."""
+    for y, x in ((y0, x0), (y1, x1)):
+        if y < 0 or x < 0 or y >= tmap.shape[0] or x >= tmap.shape[1]:
+            return True  # let the dijkstra complain about it
+    line = _bresenham(y0, x0, y1, x1)
+    for k in range(line.shape[0]):
+        if tmap[line[k, 0], line[k, 1]] > FREE_COST:
+            return True
+    return False
+
 
 class Pathplanner:
 
@@ -29,134 +79,264 @@ class Pathplanner:
                 everything in between can be reshuffled by the tsp algorithm.
         """
 
-        self.map = np.clip(255 - skimage.io.imread(map_image_path), 1, 255)
+        # numba wants a contiguous array
+        self.map = np.ascontiguousarray(np.clip(255 - skimage.io.imread(map_image_path), FREE_COST, 255), dtype=np.uint8)
+        _los_blocks(self.map, 0, 0, 0, 0)  # trigger jit compilation so the first request isn't penalized
         self.product_locations = locations
         self.locations_hash = self._get_hash_of_locations(locations)
+        # row/column of each ean in the distance matrices, the user comes last
+        self.location_ids = {ean: i for i, ean in enumerate(list(locations) + ['_user'])}
 
-        self.inter_product_distances = list()
+        # symmetric (N+1)x(N+1) matrix, the last row/column is reserved for the user.
+        # routes are computed on demand, NaN marks pairs that are not known yet
+        self.inter_product_distances = np.full((len(self.location_ids), len(self.location_ids)), np.nan, dtype=np.float32)
+        np.fill_diagonal(self.inter_product_distances, 0)
         self.inter_product_paths = dict()
+        # content of the cache file, so storing doesn't need to read it again
+        self._cache_data = dict()
+        self._user_routes_cache = OrderedDict()
+        # (snapped user location, selected eans, end ean) -> (path, route)
+        self._route_cache = OrderedDict()
+        self._routes_lock = threading.Lock()
+        # guards the in-memory caches, flask serves requests from several threads
+        self._cache_lock = threading.Lock()
 
-        if not self._load_distance_and_paths():
-            self.inter_product_distances, self.inter_product_paths = self._calculate_inter_product_routes()
-            self._store_distance_and_paths()
+        self._load_distance_and_paths()
 
     def _get_hash_of_locations(self, locations):
-        m = hashlib.sha1()
-        m.update(str(locations).encode('utf-8'))
+        m = hashlib.blake2b(digest_size=16)
+        m.update(CACHE_VERSION.to_bytes(4, 'little'))
+        m.update(np.asarray(list(locations.values()), dtype=np.int32).tobytes())
+        # the eans are part of the key since the cached paths are looked up by them
+        m.update("\0".join(locations).encode('utf-8'))
         return m.hexdigest()
 
-    def _load_distance_and_paths(self):
+    def _read_cache_file(self):
         if not os.path.exists(CACHE_PATH):
-            print("No cache file for distances!")
-            return False
-        print("Loading distances and paths from file!")
+            logger.info("No cache file for distances!")
+            return {}
         with open(CACHE_PATH, 'rb') as f:
             try:
-                data = pickle.load(f)
+                return pickle.load(f)
             except EOFError:
-                print("Empty pickle cache")
-                return False
-            if self.locations_hash not in data.keys():
-                print("No cache for this locations hash found")
-                return False
-            self.inter_product_distances = data[self.locations_hash]['product_distances']
-            self.inter_product_paths = data[self.locations_hash]['product_paths']
+                logger.info("Empty pickle cache")
+                return {}
+
+    def _load_distance_and_paths(self):
+        logger.info("Loading distances and paths from file!")
+        self._cache_data = self._read_cache_file()
+        if self.locations_hash not in self._cache_data:
+            logger.info("No cache for this locations hash found")
+            return False
+        self.inter_product_distances = self._cache_data[self.locations_hash]['product_distances']
+        self.inter_product_paths = self._cache_data[self.locations_hash]['product_paths']
 
         return True
 
     def _store_distance_and_paths(self):
-        print("Storing")
-        try:
-            with open(CACHE_PATH, 'rb') as f:
-                data = pickle.load(f)
-        except (FileNotFoundError, EOFError):
-            data = {}
-        data[self.locations_hash] = {
+        logger.info("Storing distances and paths to file")
+        self._cache_data[self.locations_hash] = {
             "product_distances": self.inter_product_distances,
             "product_paths": self.inter_product_paths,
         }
-        with open(CACHE_PATH, 'wb') as f:
-            pickle.dump(data, f)
+        # write to a temporary file first, so a server killed while storing doesn't leave a broken cache
+        tmp_path = f"{CACHE_PATH}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self._cache_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CACHE_PATH)
 
-    def _calculate_inter_product_routes(self):
-        inter_product_distances = []
-        inter_product_paths = {}
+    def _raise_if_out_of_bounds(self, loc):
         map_bounds = np.shape(self.map)
-
-        def raise_if_out_of_bounds(loc):
-            if loc[0] >= map_bounds[0] or loc[1] >= map_bounds[1] or loc[0] < 0 or loc[1] < 0:
-                raise ValueError(f'location {loc} is out of bounds {map_bounds}')
-
-        inter_product_paths = dict()
-        inter_product_distances = []
-
-        # tqdm creates a progress bar to show the process of the path computation
-        num_prods = len(self.product_locations)
-        num_iters = (num_prods*num_prods)/2 - num_prods
-        t = tqdm.tqdm(total=num_iters)
-        ean_start_index = 0
-        for ean_start, loc_start in list(self.product_locations.items())[:-1]:
-            inter_product_paths[ean_start] = dict()
-            raise_if_out_of_bounds(loc_start)
-            for ean_end, loc_end in list(self.product_locations.items())[ean_start_index+1:]:
-                raise_if_out_of_bounds(loc_end)
-                path, cost = None, None
-                path, cost = skimage.graph.route_through_array(
-                    self.map, start=loc_start, end=loc_end, fully_connected=True)
-                assert cost > 0, "Products must not have the same locations"
-                inter_product_paths[ean_start][ean_end] = path
-                inter_product_distances.append((ean_start, ean_end, cost))
-                t.update(1)
-            ean_start_index += 1
-        t.close()
-        return inter_product_distances, inter_product_paths
+        if loc[0] >= map_bounds[0] or loc[1] >= map_bounds[1] or loc[0] < 0 or loc[1] < 0:
+            raise ValueError(f'location {loc} is out of bounds {map_bounds}')
+
+    def _ensure_inter_product_routes(self, eans):
+        """Compute the routes between all given products that are not known yet and store them to the cache file."""
+        with self._routes_lock:
+            found_new_routes = False
+            for ean_start in eans:
+                i_start = self.location_ids[ean_start]
+                missing = [ean for ean in eans
+                           if ean != ean_start and np.isnan(self.inter_product_distances[i_start, self.location_ids[ean]])]
+                if not missing:
+                    continue
+                loc_start = self.product_locations[ean_start]
+                self._raise_if_out_of_bounds(loc_start)
+                for ean_end in missing:
+                    self._raise_if_out_of_bounds(self.product_locations[ean_end])
+                # at most one dijkstra sweep from loc_start yields the paths to all missing products
+                routes = self._calculate_routes_from(loc_start, [self.product_locations[ean] for ean in missing])
+                for ean_end, (path, cost) in zip(missing, routes):
+                    assert cost > 0, "Products must not have the same locations"
+                    self.inter_product_paths.setdefault(ean_start, dict())[ean_end] = path
+                    i_end = self.location_ids[ean_end]
+                    self.inter_product_distances[i_start, i_end] = self.inter_product_distances[i_end, i_start] = cost
+                found_new_routes = True
+            # stored right away, the server is stopped with SIGTERM which doesn't run atexit handlers
+            if found_new_routes:
+                self._store_distance_and_paths()
+
+    def _calculate_routes_from(self, loc_start, locs_end):
+        """Compute the cheapest paths from loc_start to all locs_end.
+
+        Targets in line of sight get the straight bresenham line, only the others
+        are routed with a single dijkstra sweep.
+
+        Returns:
+            list of (path, cost) tuples in the order of locs_end, paths are (n, 2) int16 arrays of (y,x)
+        """
+        routes = [None] * len(locs_end)
+        blocked = []
+        for i, loc_end in enumerate(locs_end):
+            if _los_blocks(self.map, loc_start[0], loc_start[1], loc_end[0], loc_end[1]):
+                blocked.append(i)
+            else:
+                routes[i] = self._straight_route(loc_start, loc_end)
+
+        if blocked:
+            mcp = skimage.graph.MCP_Geometric(self.map, fully_connected=True)
+            costs, _ = mcp.find_costs(starts=[loc_start], ends=[locs_end[i] for i in blocked])
+            for i in blocked:
+                path = np.asarray(mcp.traceback(locs_end[i]), dtype=np.int16)
+                routes[i] = (path, costs[tuple(locs_end[i])])
+        return routes
+
+    def _straight_route(self, loc_start, loc_end):
+        """Path and cost of the straight line between two locations without obstacles in between."""
+        path = _bresenham(loc_start[0], loc_start[1], loc_end[0], loc_end[1]).astype(np.int16)
+        # same cost as the 8-connected dijkstra: straight steps cost 1, diagonal steps sqrt(2)
+        dy, dx = abs(loc_end[0] - loc_start[0]), abs(loc_end[1] - loc_start[1])
+        cost = FREE_COST * (max(dy, dx) - min(dy, dx) + np.sqrt(2) * min(dy, dx))
+        return path, cost
 
     def _calculate_user_product_routes(self, user_loc):
 
         paths = self.inter_product_paths.copy()
         dists = self.inter_product_distances.copy()
-        paths['_user'] = dict()
-
-        # compute distance and path to all products
-        for ean_target, loc_target in self.product_locations.items():
-            path, cost = skimage.graph.route_through_array(
-                self.map, start=user_loc, end=loc_target, fully_connected=True)
-            paths['_user'][ean_target] = path
-            dists.append(('_user', ean_target, cost))
+        user_dists, paths['_user'] = self._get_user_routes(user_loc)
+        user_id = self.location_ids['_user']
+        dists[user_id, :user_id] = dists[:user_id, user_id] = user_dists
 
         return dists, paths
 
-    def _get_max_index_value_in_dists(self, dists):
-        return np.max([max(dist_point[0], dist_point[1]) for dist_point in dists])
+    @staticmethod
+    def _snap_location(loc):
+        return loc[0] // USER_LOCATION_SNAP, loc[1] // USER_LOCATION_SNAP
 
-    def _get_indices_in_dist(self, dists):
-        indices = set([d[0] for d in dists])
-        indices.update(set([d[1] for d in dists]))
-        return list(indices)
+    def _get_user_routes(self, user_loc):
+        """Distances and paths from the user to all products.
+
+        The result is reused for all user locations within the same USER_LOCATION_SNAP pixel cell.
+        """
+        key = self._snap_location(user_loc)
+        with self._cache_lock:
+            cached = self._user_routes_cache.get(key)
+            if cached is not None:
+                self._user_routes_cache.move_to_end(key)
+                return cached
+
+        # compute distance and path to all products with a single sweep from the user
+        routes = self._calculate_routes_from(user_loc, list(self.product_locations.values()))
+        user_dists = np.array([cost for _, cost in routes], dtype=np.float32)
+        user_paths = {ean_target: path for ean_target, (path, _) in zip(self.product_locations.keys(), routes)}
+
+        with self._cache_lock:
+            self._user_routes_cache[key] = user_dists, user_paths
+            if len(self._user_routes_cache) > USER_ROUTES_CACHE_SIZE:
+                self._user_routes_cache.popitem(last=False)
+        return user_dists, user_paths
 
     def _insert_dummy_node(self, dists, user_id, end_id):
-        assert end_id in self._get_indices_in_dist(dists), "end id not in dists list"
-
-        """Insert a dummy node between the user node and the last node."""
-        self.dummy_id = self._get_max_index_value_in_dists(dists) + 1
-        dists.append((user_id, self.dummy_id, 1))
-        dists.append((self.dummy_id, end_id, 1))
-        return dists
-
-    def _do_tsp(self, dist_list):
-        """Do the actual travelling salesperson."""
-        dist_list.sort(key=lambda x: x[0])
-        length = int(self._get_max_index_value_in_dists(dist_list) + 1)
-        try:
-            fitness_dists = mlrose.TravellingSales(distances=dist_list)
-            problem_fit = mlrose.TSPOpt(
-                length=length, fitness_fn=fitness_dists, maximize=False)
-            best_state, best_fitness = mlrose.genetic_alg(
-                problem_fit, mutation_prob=0.2, max_attempts=50)
-        except Exception:
-            print(f"tsp failed. dist_list: {dist_list}")
-            raise
-        return best_state
+        """Insert a dummy node between the user node and the last node.
+
+        Returns the extended matrix and the id of the dummy node.
+        """
+        assert end_id < len(dists), "end id not in dists matrix"
+
+        dummy_id = len(dists)
+        dists_with_dummy = np.full((len(dists) + 1, len(dists) + 1), np.inf, dtype=dists.dtype)
+        dists_with_dummy[:-1, :-1] = dists
+        dists_with_dummy[dummy_id, dummy_id] = 0
+        for node_id in (user_id, end_id):
+            dists_with_dummy[node_id, dummy_id] = dists_with_dummy[dummy_id, node_id] = 1
+        return dists_with_dummy, dummy_id
+
+    def _do_tsp(self, dist_matrix):
+        """Do the actual travelling salesperson.
+
+        Small problems are solved exactly with held-karp, larger ones with a 2-opt heuristic.
+        Pairs with infinite distance are not connected.
+        """
+        if len(dist_matrix) <= HELD_KARP_MAX_NODES:
+            route = self._held_karp(dist_matrix)
+        else:
+            route = self._two_opt(dist_matrix)
+        if np.isinf(self._route_cost(dist_matrix, route)):
+            logger.error("tsp failed. dist_matrix: %s", dist_matrix)
+            raise ValueError("no round trip through all nodes found")
+        return route
+
+    @staticmethod
+    def _route_cost(dist_matrix, route):
+        """Cost of the round trip along route."""
+        return dist_matrix[route, np.roll(route, -1)].sum()
+
+    @staticmethod
+    def _held_karp(dist_matrix):
+        """Exact round trip starting at node 0 via dynamic programming over node subsets."""
+        n = len(dist_matrix)
+        masks = np.arange(1 << n)
+        popcount = np.zeros(len(masks), dtype=int)
+        for bit in range(n):
+            popcount += (masks >> bit) & 1
+        # cost[mask, j]: cheapest path that starts at 0, visits all nodes in mask and ends at j
+        cost = np.full((len(masks), n), np.inf)
+        parent = np.zeros((len(masks), n), dtype=int)
+        cost[1, 0] = 0
+        for size in range(2, n + 1):
+            layer = masks[(popcount == size) & (masks & 1 == 1)]
+            for j in range(1, n):
+                with_j = layer[(layer >> j) & 1 == 1]
+                candidates = cost[with_j ^ (1 << j)] + dist_matrix[:, j]
+                best = np.argmin(candidates, axis=1)
+                cost[with_j, j] = candidates[np.arange(len(with_j)), best]
+                parent[with_j, j] = best
+
+        mask = len(masks) - 1
+        node = int(np.argmin(cost[mask] + dist_matrix[:, 0]))
+        route = []
+        while node != 0:
+            route.append(node)
+            mask, node = mask ^ (1 << node), parent[mask, node]
+        route.append(0)
+        return np.array(route[::-1])
+
+    @staticmethod
+    def _two_opt(dist_matrix):
+        """Nearest neighbour round trip starting at node 0, improved with 2-opt moves."""
+        n = len(dist_matrix)
+        # unconnected pairs get a penalty larger than any round trip over connected pairs
+        finite = np.isfinite(dist_matrix)
+        dist_matrix = np.where(finite, dist_matrix, dist_matrix[finite].sum() + 1)
+
+        route = [0]
+        unvisited = set(range(1, n))
+        while unvisited:
+            nearest = min(unvisited, key=lambda node: dist_matrix[route[-1], node])
+            route.append(nearest)
+            unvisited.remove(nearest)
+        route = np.array(route)
+
+        improved = True
+        while improved:
+            improved = False
+            for i in range(1, n - 1):
+                for k in range(i + 1, n):
+                    a, b, c, d = route[i - 1], route[i], route[k], route[(k + 1) % n]
+                    if dist_matrix[a, c] + dist_matrix[b, d] < dist_matrix[a, b] + dist_matrix[c, d] - 1e-9:
+                        route[i:k + 1] = route[i:k + 1][::-1]
+                        improved = True
+        return route
 
     def _roll_route(self, start_id: int, end_id: int, route: List[int]) -> List[int]:
         """Roll the route such that the start_id is at the start of the route."""
@@ -165,73 +345,101 @@ class Pathplanner:
             route = np.flip(np.roll(route, -1))
         return route
 
-    def _route_to_path(self, route: List[int], paths) -> List[Tuple[int]]:
-        """Piece together the paths between the route destinations."""
-        path = []
+    def _route_to_path(self, route: List[int], paths) -> np.ndarray:
+        """Piece together the paths between the route destinations into one (n, 2) array of (y,x)."""
+        path_parts = []
         start = route[0]
         for target in route[1:]:
             end = target
             try:
                 path_part = paths[start][end]
             except KeyError:  # we only saved one way, so let's try the same path in reverse
-                path_part = reversed(paths[end][start])
-            path.extend(path_part)
+                path_part = paths[end][start][::-1]
+            path_parts.append(path_part)
             start = end
-        return path
+        if not path_parts:
+            return np.empty((0, 2), dtype=np.int16)
+        return np.concatenate(path_parts)
 
-    def _filter_dists(self, selected_artikel_eans, dist_list):
+    def _filter_dists(self, selected_artikel_eans, dists):
+        """Cut the distances between the selected products and the user out of the full matrix.
 
-        selected_artikel_eans_and_user = selected_artikel_eans + ["_user"]
-
-        def is_in_spid(src, target):
-            in_selected_products = src in selected_artikel_eans_and_user and target in selected_artikel_eans_and_user
-            return in_selected_products
-
-        ean_to_tsp_id = {}
-        filtered_dists_with_tsp_id = []
-        for src, target, dist in dist_list:
-            if is_in_spid(src, target):
-                new_src_idx = list(selected_artikel_eans_and_user).index(src)
-                new_target_idx = list(selected_artikel_eans_and_user).index(target)
-                ean_to_tsp_id[src] = new_src_idx
-                ean_to_tsp_id[target] = new_target_idx
-
-                filtered_dists_with_tsp_id.append((new_src_idx, new_target_idx, dist))
-
-        return filtered_dists_with_tsp_id, ean_to_tsp_id
+        The tsp id of each ean is its row/column in the returned matrix.
+        """
+        selected_artikel_eans_and_user = tuple(selected_artikel_eans) + ("_user",)
+        ean_to_tsp_id = {ean: tsp_id for tsp_id, ean in enumerate(selected_artikel_eans_and_user)}
+        location_ids = [self.location_ids[ean] for ean in selected_artikel_eans_and_user]
+        return dists[np.ix_(location_ids, location_ids)], ean_to_tsp_id
 
-    def _remove_dummy(self, route_with_dummy):
+    def _remove_dummy(self, route_with_dummy, dummy_id):
         route_no_dummy = list(route_with_dummy)
-        route_no_dummy.remove(self.dummy_id)
+        route_no_dummy.remove(dummy_id)
         return route_no_dummy
 
     def _convert_route_from_tsp_id_to_ean(self, ean_to_tsp_id: dict, rolled_route: List[int]):
-        def invert_lookup(d: dict, v):
-            ndx = list(d.values()).index(v)
-            return list(d.keys())[ndx]
-        ean_route = [invert_lookup(ean_to_tsp_id, tsp_id) for tsp_id in rolled_route]
+        tsp_id_to_ean = {tsp_id: ean for ean, tsp_id in ean_to_tsp_id.items()}
+        ean_route = [tsp_id_to_ean[tsp_id] for tsp_id in rolled_route]
         return ean_route
 
 
     def get_path(self, user_location, selected_artikel_eans, end_ean):
+        # tuple so the caller's shopping list isn't modified
+        selected_artikel_eans = tuple(selected_artikel_eans)
         if end_ean not in selected_artikel_eans:
-            selected_artikel_eans.append(end_ean)
-
-        dist_list_ean_all_with_user, paths = self._calculate_user_product_routes(user_location)
-        dist_list_tspids_selected_with_user, ean_to_tsp_id = self._filter_dists(selected_artikel_eans, dist_list_ean_all_with_user)
+            selected_artikel_eans += (end_ean,)
+        self._ensure_inter_product_routes(selected_artikel_eans)
+
+        key = (self._snap_location(user_location), frozenset(selected_artikel_eans), end_ean)
+        with self._cache_lock:
+            cached = self._route_cache.get(key)
+            if cached is not None:
+                self._route_cache.move_to_end(key)
+                return cached
+            route_with_eans = self._get_cached_route_order(user_location, key[1], end_ean)
+
+        dists_ean_all_with_user, paths = self._calculate_user_product_routes(user_location)
+        if route_with_eans is None:
+            route_with_eans = self._calculate_route(selected_artikel_eans, end_ean, dists_ean_all_with_user)
+        path = self._route_to_path(route_with_eans, paths)
+
+        with self._cache_lock:
+            self._route_cache[key] = path, route_with_eans
+            if len(self._route_cache) > ROUTE_CACHE_SIZE:
+                self._route_cache.popitem(last=False)
+        return path, route_with_eans
+
+    def _get_cached_route_order(self, user_location, selected_artikel_eans: frozenset, end_ean):
+        """Reuse the rest of a cached route after the user picked up its first products.
+
+        This only applies if the removed products are exactly the leading stops of the cached route
+        and the user stands at the last of them, i.e. where the rest of the cached route starts;
+        otherwise the old order isn't known to be good.
+        Must be called with _cache_lock held.
+        """
+        for (_, cached_eans, cached_end_ean), (_, cached_route) in reversed(self._route_cache.items()):
+            if cached_end_ean != end_ean or not selected_artikel_eans < cached_eans:
+                continue
+            num_picked = len(cached_eans) - len(selected_artikel_eans)
+            picked = cached_route[1:1 + num_picked]
+            if (set(picked) == cached_eans - selected_artikel_eans and
+                    self._snap_location(user_location) == self._snap_location(self.product_locations[picked[-1]])):
+                return ['_user'] + list(cached_route[1 + num_picked:])
+        return None
+
+    def _calculate_route(self, selected_artikel_eans, end_ean, dists_ean_all_with_user):
+        """Solve the tsp from the user through all selected products to the end."""
+        dists_tspids_selected_with_user, ean_to_tsp_id = self._filter_dists(selected_artikel_eans, dists_ean_all_with_user)
         end_tsp_id = ean_to_tsp_id[end_ean]
         user_tsp_id = ean_to_tsp_id['_user']
-        dist_list_tspids_selected_with_user_and_dummy = self._insert_dummy_node(dist_list_tspids_selected_with_user, user_tsp_id, end_tsp_id)
-        print(f"calculated dist_list = {dist_list_tspids_selected_with_user_and_dummy}")
-        route_with_dummy = self._do_tsp(dist_list_tspids_selected_with_user_and_dummy)
-        print(f"calculated route = {route_with_dummy}")
-        route_no_dummy = self._remove_dummy(route_with_dummy)
-        print(f"route with product location indices = {route_no_dummy}")
+        dists_tspids_selected_with_user_and_dummy, dummy_id = self._insert_dummy_node(dists_tspids_selected_with_user, user_tsp_id, end_tsp_id)
+        logger.debug("calculated dists = %s", dists_tspids_selected_with_user_and_dummy)
+        route_with_dummy = self._do_tsp(dists_tspids_selected_with_user_and_dummy)
+        logger.debug("calculated route = %s", route_with_dummy)
+        route_no_dummy = self._remove_dummy(route_with_dummy, dummy_id)
+        logger.debug("route with product location indices = %s", route_no_dummy)
         rolled_route = self._roll_route(start_id=user_tsp_id, end_id=end_tsp_id, route=route_no_dummy)
-        print(f"rolled_route = {rolled_route}")
-        rolled_route_with_eans = self._convert_route_from_tsp_id_to_ean(ean_to_tsp_id, rolled_route)
-        path = self._route_to_path(rolled_route_with_eans, paths)
-        return path, rolled_route_with_eans
+        logger.debug("rolled_route = %s", rolled_route)
+        return self._convert_route_from_tsp_id_to_ean(ean_to_tsp_id, rolled_route)
 
 
 if __name__ == "__main__":
@@ -1,60 +1,173 @@
 import unittest
+import itertools
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
 
 from pathplanning.pathplanning import Pathplanner, Path
 class TestPathPlanning(unittest.TestCase):
 
     map_path = 'app/pathplanning/map.png'
+    positions = {"_kasse": (850, 60), "0000001": (100, 212), "0000002": (150, 212), "0000003": (190, 212)}
+
+    def setUp(self):
+        # every test starts without a cache file
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_path = os.path.join(tmp_dir.name, 'cache.pickle')
+        patcher = mock.patch('pathplanning.pathplanning.CACHE_PATH', self.cache_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_caching(self):
-        positions = [(850, 60), (100, 212), (150, 212), (190, 212)]
-        pp = Pathplanner(self.map_path, positions)
+        pp = Pathplanner(self.map_path, self.positions)
+        pp._ensure_inter_product_routes(list(self.positions))
         print(pp.inter_product_distances)
-        # check 
-        indices = pp._get_indices_in_dist(pp.inter_product_distances) 
-        for i in range(len(positions)):
-            self.assertTrue((i+1) in indices)
-        self.assertTrue(len(indices) == len(positions))
-        self.assertTrue(0 not in indices)
+        # check
+        dists = pp.inter_product_distances
+        self.assertEqual(dists.shape, (len(self.positions) + 1, len(self.positions) + 1))
+        self.assertTrue(np.isfinite(dists[:-1, :-1]).all())
+        self.assertTrue(np.array_equal(dists, dists.T, equal_nan=True))
+        self.assertTrue(np.isnan(dists[-1, :-1]).all())  # no user yet
+
+    def test_lazy_routes(self):
+        pp = Pathplanner(self.map_path, self.positions)
+        pp._ensure_inter_product_routes(["0000001", "0000002"])
+        ids = [pp.location_ids["0000001"], pp.location_ids["0000002"], pp.location_ids["0000003"]]
+        self.assertTrue(np.isfinite(pp.inter_product_distances[ids[0], ids[1]]))
+        self.assertTrue(np.isnan(pp.inter_product_distances[ids[0], ids[2]]))
+
+        # the new routes are stored right away and picked up by the next instance
+        self.assertTrue(os.path.exists(self.cache_path))
+        pp2 = Pathplanner(self.map_path, self.positions)
+        self.assertEqual(pp2.inter_product_distances[ids[0], ids[1]], pp.inter_product_distances[ids[0], ids[1]])
+
+    def test_cache_keeps_other_locations(self):
+        other_positions = dict(self.positions, **{"0000004": (300, 437)})
+        other_pp = Pathplanner(self.map_path, other_positions)
+        other_pp._ensure_inter_product_routes(["0000001", "0000004"])
+
+        # entries of other locations that were in the file at startup survive storing
+        pp = Pathplanner(self.map_path, self.positions)
+        pp._ensure_inter_product_routes(["0000001", "0000002"])
+        for positions, pair in ((self.positions, ("0000001", "0000002")), (other_positions, ("0000001", "0000004"))):
+            reloaded = Pathplanner(self.map_path, positions)
+            ids = [reloaded.location_ids[ean] for ean in pair]
+            self.assertTrue(np.isfinite(reloaded.inter_product_distances[ids[0], ids[1]]))
 
     # def test_roll(self):
     #     positions = [(850, 60), (100, 212), (150, 212), (190, 212)]
     #     pp = Pathplanner('app/pathplanning/map.png', positions)
-    #     p2 = Pathplanner._roll_route([0,2,3,1], )    
+    #     p2 = Pathplanner._roll_route([0,2,3,1], )
 
 
     def test_full(self):
-        pp = Pathplanner(self.map_path, [(850, 60), (100, 212), (150, 212), (190, 212),
-        (300, 437), (700, 212), (650, 112), (700, 112), (999, 400)])
-        p, r = pp.get_path((10, 10), [1,2,3], 2)
+        positions = dict(self.positions)
+        positions.update({"0000004": (300, 437), "0000005": (700, 212), "0000006": (650, 112),
+                          "0000007": (700, 112), "0000008": (999, 400)})
+        pp = Pathplanner(self.map_path, positions)
+        p, r = pp.get_path((10, 10), ["0000001", "0000002", "0000003"], "_kasse")
         print(p, r)
+        self.assertEqual(r[0], '_user')
+        self.assertEqual(r[-1], '_kasse')
+        self.assertEqual(set(r[1:-1]), {"0000001", "0000002", "0000003"})
 
-    def test_add_user_position(self):
-        positions = [(850, 60), (100, 212), (150, 212), (190, 212)]
+    def test_route_cache(self):
+        pp = Pathplanner(self.map_path, self.positions)
+        selected = ["0000001", "0000002", "0000003"]
+        p, r = pp.get_path((10, 10), selected, "_kasse")
+        self.assertIs(pp.get_path((11, 12), selected, "_kasse")[1], r)
+
+        # after picking up the first product the rest of the route is reused
+        picked = r[1]
+        p2, r2 = pp.get_path(self.positions[picked], [ean for ean in selected if ean != picked], "_kasse")
+        self.assertEqual(r2, ['_user'] + list(r[2:]))
+        self.assertEqual(tuple(p2[-1]), self.positions["_kasse"])
+
+    def test_route_cache_two_picked(self):
+        positions = dict(self.positions)
+        positions.update({"0000004": (300, 437), "0000005": (700, 212)})
+        pp = Pathplanner(self.map_path, positions)
+        selected = ["0000001", "0000002", "0000003", "0000004", "0000005"]
+        p, r = pp.get_path((10, 10), selected, "_kasse")
+        remaining = [ean for ean in selected if ean not in r[1:3]]
+
+        with mock.patch.object(pp, '_calculate_route', wraps=pp._calculate_route) as calculate_route:
+            # at the second picked product the rest of the route still starts where the user is
+            p2, r2 = pp.get_path(positions[r[2]], remaining, "_kasse")
+            self.assertEqual(r2, ['_user'] + list(r[3:]))
+            self.assertEqual(calculate_route.call_count, 0)
+
+            # still at the first one, the old order isn't known to be good from here
+            pp.get_path(positions[r[1]], remaining, "_kasse")
+            self.assertEqual(calculate_route.call_count, 1)
+
+    def test_route_cache_resolves_elsewhere(self):
+        pp = Pathplanner(self.map_path, self.positions)
+        selected = ["0000001", "0000002", "0000003"]
+        p, r = pp.get_path((10, 10), selected, "_kasse")
+
+        # removing a product somewhere else in the store needs a new tsp
+        with mock.patch.object(pp, '_calculate_route', wraps=pp._calculate_route) as calculate_route:
+            pp.get_path((600, 300), [ean for ean in selected if ean != r[1]], "_kasse")
+            pp.get_path(self.positions[r[2]], [ean for ean in selected if ean != r[2]], "_kasse")
+        self.assertEqual(calculate_route.call_count, 2)
+
+    def test_concurrent_routes(self):
+        positions = dict(self.positions)
+        positions.update({"0000004": (300, 437), "0000005": (700, 212), "0000006": (650, 112),
+                          "0000007": (700, 112), "0000008": (999, 400)})
         pp = Pathplanner(self.map_path, positions)
+        eans = [ean for ean in positions if ean != "_kasse"]
+        pp._ensure_inter_product_routes(list(positions))
+        dists, _ = pp._calculate_user_product_routes((10, 10))
+
+        # baskets of different sizes, so the dummy node has a different id in each thread
+        baskets = [eans[:n] + ["_kasse"] for n in (1, 3, 5, 8)] * 20
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            routes = list(executor.map(lambda basket: pp._calculate_route(basket, "_kasse", dists), baskets))
+        for basket, route in zip(baskets, routes):
+            self.assertEqual(route[0], '_user')
+            self.assertEqual(route[-1], '_kasse')
+            self.assertEqual(set(route[1:]), set(basket))
+
+    def test_add_user_position(self):
+        pp = Pathplanner(self.map_path, self.positions)
         new_dist, new_path = pp._calculate_user_product_routes((0,0))
 
-        indices = pp._get_indices_in_dist(new_dist)
-        for i in range(len(positions)):
-            self.assertTrue((i+1) in indices)
-        self.assertTrue(len(indices) == len(positions) + 1)
-        self.assertTrue(pp.user_position_id in indices)
-        self.assertTrue(pp.user_position_id == 0)
-        
+        self.assertTrue(np.isfinite(new_dist[-1]).all())
+        self.assertEqual(set(new_path['_user']), set(self.positions))
+
         # insert dummy node:
-        end_id = 3
-        dist_dummy = pp._insert_dummy_node(new_dist, end_id)
-        indices = pp._get_indices_in_dist(new_dist)
-        for i in range(len(positions)):
-            self.assertTrue((i+1) in indices)
-        self.assertTrue(len(indices) == len(positions) + 2)
-        self.assertTrue(pp.user_position_id in indices)
-        self.assertTrue(end_id in indices)
-        self.assertTrue(pp.user_position_id == 0)
-        
+        selected = ["0000001", "_kasse"]
+        dists, ean_to_tsp_id = pp._filter_dists(selected, new_dist)
+        self.assertEqual(dists.shape, (len(selected) + 1, len(selected) + 1))
+        dist_dummy, dummy_id = pp._insert_dummy_node(dists, ean_to_tsp_id['_user'], ean_to_tsp_id['_kasse'])
+        self.assertEqual(dist_dummy.shape, (len(selected) + 2, len(selected) + 2))
+        connected = np.flatnonzero(np.isfinite(dist_dummy[dummy_id]))
+        self.assertEqual(set(connected), {dummy_id, ean_to_tsp_id['_user'], ean_to_tsp_id['_kasse']})
+
+    def test_tsp(self):
+        rng = np.random.default_rng(0)
+        n = 7
+        points = rng.uniform(0, 100, size=(n, 2))
+        dist_matrix = np.linalg.norm(points[:, None] - points[None], axis=-1)
+        best = min(Pathplanner._route_cost(dist_matrix, np.array((0,) + perm))
+                   for perm in itertools.permutations(range(1, n)))
+
+        for solver in (Pathplanner._held_karp, Pathplanner._two_opt):
+            route = solver(dist_matrix)
+            self.assertEqual(sorted(route), list(range(n)))
+            self.assertGreaterEqual(Pathplanner._route_cost(dist_matrix, route), best - 1e-9)
+        self.assertAlmostEqual(Pathplanner._route_cost(dist_matrix, Pathplanner._held_karp(dist_matrix)), best)
+
     def test_roll_route(self):
         pass
 
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()